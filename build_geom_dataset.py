@@ -1,7 +1,8 @@
 import argparse
+import contextlib
+import multiprocessing
 import os
 import pickle
-import random
 import sys
 
 import numpy as np
@@ -9,7 +10,7 @@ import rdkit
 import torch
 import tqdm
 from rdkit import Chem
-from rdkit.Chem import QED, AllChem, Descriptors, Descriptors3D, RDConfig
+from rdkit.Chem import QED, AllChem, RDConfig, rdMolDescriptors
 from torch.utils.data import (BatchSampler, DataLoader, Dataset,
                               SequentialSampler)
 
@@ -19,103 +20,230 @@ import sascorer
 from qm9.data import collate as qm9_collate
 
 
-def extract_properties(mol_3D, smi):
+def extract_properties(smi):
+    # 2D descriptors only depend on the SMILES, so they are shared by all
+    # conformers of a molecule. Asphericity is computed per conformer.
     mol = Chem.MolFromSmiles(smi)
     properties = {}
     properties['qed'] = QED.qed(mol)
-    properties['logp'] = Descriptors.MolLogP(mol)
+    properties['logp'] = rdMolDescriptors.CalcCrippenDescriptors(mol)[0]
     properties['sas'] = sascorer.calculateScore(mol)
-    properties['Asphericity'] = Descriptors3D.Asphericity(mol_3D)
     return properties
 
+def process_pickle(path, conformations, remove_h, seed=0):
+    """ Extract up to `conformations` random conformers from one GEOM pickle.
+
+    Returns the SMILES string, the number of atoms of each kept conformer and
+    one (atom_type, coords, props) tuple per conformer, where atom_type is an
+    int8 array of atomic numbers (n_atoms,), coords a float32 array
+    (n_atoms x 3) and props a float32 array [qed, logp, sas, asphericity].
+    """
+    rng = np.random.default_rng(seed)
+    with open(path, 'rb') as f:
+        drug_pkl = pickle.load(f)
+    smiles = drug_pkl['smiles']
+    conformers = drug_pkl['conformers']
+    # Keep a random subset of the conformers (the energies are not used).
+    k = min(conformations, len(conformers))
+    idxs = rng.choice(len(conformers), size=k, replace=False)
+
+    base_props = list(extract_properties(smiles).values())
+    n_atoms_list = []
+    conformer_list = []
+    for id in idxs:
+        conformer = conformers[id]
+        mol = conformer['rd_mol']
+        n = mol.GetNumAtoms()
+        atom_type = np.fromiter((atom.GetAtomicNum() for atom in mol.GetAtoms()),
+                                dtype=np.int8, count=n)
+        coords = mol.GetConformer().GetPositions().astype(np.float32)        # n x 3
+        props = np.array(base_props + [rdMolDescriptors.CalcAsphericity(mol)], dtype=np.float32)
+        if remove_h:
+            mask = atom_type != 1
+            atom_type = atom_type[mask]
+            coords = coords[mask]
+        n_atoms_list.append(atom_type.shape[0])
+        conformer_list.append((atom_type, coords, props))
+    return smiles, n_atoms_list, conformer_list
+
+
+def _write_npy_header(f, dtype, shape):
+    np.lib.format.write_array_header_1_0(
+        f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False, 'shape': shape})
+
+
+def _process_pickle_task(task):
+    path, conformations, remove_h, seed = task
+    return process_pickle(path, conformations, remove_h, seed)
+
+
 def extract_conformers(args):
     base_dir = os.path.join(args.data_dir, args.data_file)
-    drugs_file = os.listdir(base_dir)
-    save_file = f"geom_drugs_{'no_h_' if args.remove_h else ''}{args.conformations}_random"
+    drugs_file = sorted(os.listdir(base_dir))
+    save_file = f"geom_drugs_{'no_h_' if args.remove_h else ''}{args.conformations}_random_prop"
     smiles_list_file = 'geom_drugs_smiles_random.txt'
     number_atoms_file = f"geom_drugs_n_{'no_h_' if args.remove_h else ''}{args.conformations}_random_prop"
 
-
-    all_smiles = []
+    file_paths = [os.path.join(base_dir, drugs_1k) for drugs_1k in drugs_file
+                  if drugs_1k[-6:] == 'pickle']
+    # One task per pickle file, each with its own seed so that the choice of
+    # conformers does not depend on which worker picks the file up.
+    tasks = [(path, args.conformations, args.remove_h, args.seed + i)
+             for i, path in enumerate(file_paths)]
+
+    # Every field is streamed straight into its .npy file as the results come
+    # in, so only the pickles being processed are held in memory. The headers
+    # are written with an empty first axis and patched with the final shape at
+    # the end; numpy leaves room in the header for the first axis to grow.
+    dtypes = {'mol_id': np.int32, 'atom_type': np.int8,
+              'coords': np.float32, 'props': np.float32}
+    trailing_shapes = {'mol_id': (), 'atom_type': (),
+                       'coords': (3,), 'props': (4,)}    # props: qed, logp, sas, asphericity
+    npy_paths = {name: os.path.join(args.output_dir, f'{save_file}_{name}.npy')
+                 for name in dtypes}
+    smiles_path = os.path.join(args.output_dir, smiles_list_file)
+
+    # imap returns results in file order, so mol ids and SMILES do not depend
+    # on scheduling.
     all_number_atoms = []
-    dataset_conformers = []
     mol_id = 0
-    for i, drugs_1k in enumerate(tqdm.tqdm(drugs_file)):
-        with open(os.path.join(base_dir, drugs_1k), 'rb') as f:
-            if os.path.join(base_dir, drugs_1k)[-6:] != 'pickle':
-                continue
-            drug_pkl = pickle.load(f)
-            all_smiles.append(drug_pkl['smiles'])
-            conformers = drug_pkl['conformers']
-            # Get the energy of each conformer. Keep only the lowest values
-            all_energies = []
-            for conformer in conformers:
-                all_energies.append(conformer['totalenergy'])
-            all_energies = np.array(all_energies)
-            argsort = np.argsort(all_energies)
-            #lowest_energies = argsort[:args.conformations]
-            lowest_energies = list(range(0, len(conformers)))
-            random.shuffle(lowest_energies)
-            lowest_energies  = lowest_energies[:args.conformations]
-            for id in lowest_energies:
-                conformer = conformers[id]
-                properties = np.array(list(extract_properties(conformer['rd_mol'], drug_pkl['smiles']).values()))
-                coords = np.array([conformer['rd_mol'].GetConformer().GetAtomPosition(x) for x in range(conformer['rd_mol'].GetNumAtoms())]).astype(float)        # n x 3
-                atom_type = np.array([atom.GetAtomicNum() for atom in conformer['rd_mol'].GetAtoms()]).astype(float)
-                atom_type = np.expand_dims(atom_type, 1)
-                coords = np.hstack((atom_type, coords))
-                if args.remove_h:
-                    mask = coords[:, 0] != 1.0
-                    coords = coords[mask]
-                n = coords.shape[0]
-                all_number_atoms.append(n)
-                mol_id_arr = mol_id * np.ones((n, 1), dtype=float)
-                properties_array = properties * np.ones((n, 1), dtype=float)
-                id_coords = np.hstack((mol_id_arr, coords, properties_array))
-
-                dataset_conformers.append(id_coords)
-                mol_id += 1
-
+    try:
+        with contextlib.ExitStack() as stack:
+            out_files = {name: stack.enter_context(open(path, 'wb'))
+                         for name, path in npy_paths.items()}
+            smi_f = stack.enter_context(open(smiles_path, 'w', buffering=1 << 20))
+            header_sizes = {}
+            for name, f in out_files.items():
+                _write_npy_header(f, dtypes[name], (0,) + trailing_shapes[name])
+                header_sizes[name] = f.tell()
+
+            pool = stack.enter_context(multiprocessing.Pool(args.num_workers))
+            for smiles, n_atoms_list, conformer_list in tqdm.tqdm(
+                    pool.imap(_process_pickle_task, tasks, chunksize=4), total=len(tasks)):
+                smi_f.write(smiles)
+                smi_f.write('\n')
+                all_number_atoms.extend(n_atoms_list)
+                for atom_type, coords, props in conformer_list:
+                    np.full(atom_type.shape[0], mol_id, dtype=np.int32).tofile(out_files['mol_id'])
+                    atom_type.tofile(out_files['atom_type'])
+                    coords.tofile(out_files['coords'])
+                    props.tofile(out_files['props'])
+                    mol_id += 1
+
+            total_atoms = sum(all_number_atoms)
+            first_axis = {'mol_id': total_atoms, 'atom_type': total_atoms,
+                          'coords': total_atoms, 'props': mol_id}
+            for name, f in out_files.items():
+                f.seek(0)
+                _write_npy_header(f, dtypes[name], (first_axis[name],) + trailing_shapes[name])
+                assert f.tell() == header_sizes[name], f'Header of {name} changed size.'
+    except BaseException:
+        # Do not leave partial outputs behind.
+        for path in list(npy_paths.values()) + [smiles_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    all_number_atoms = np.fromiter(all_number_atoms, dtype=np.int32,
+                                   count=len(all_number_atoms))
     print("Total number of conformers saved", mol_id)
-    all_number_atoms = np.array(all_number_atoms)
-    dataset = np.vstack(dataset_conformers)
-
-    print("Total number of atoms in the dataset", dataset.shape[0])
-    print("Average number of atoms per molecule", dataset.shape[0] / mol_id)
-
-    # Save conformations
-    np.save(os.path.join(args.output_dir, save_file), dataset)
-    # Save SMILES
-    with open(os.path.join(args.output_dir, smiles_list_file), 'w') as f:
-        for s in all_smiles:
-            f.write(s)
-            f.write('\n')
+    print("Total number of atoms in the dataset", total_atoms)
+    print("Average number of atoms per molecule", total_atoms / mol_id)
 
     # Save number of atoms per conformation
     np.save(os.path.join(args.output_dir, number_atoms_file), all_number_atoms)
     print("Dataset processed.")
 
 
-def load_split_data(args, conformation_file, val_proportion=0.1, test_proportion=0.1,
-                    filter_size=None):
-    from pathlib import Path
-    path = Path(conformation_file)
-    base_path = path.parent.absolute()
+def split_and_sizes(mol_id):
+    """ Return the indices where a new molecule starts in the per-atom
+    mol_id array, and the number of atoms of each molecule. """
+    if len(mol_id) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    split_indices = np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1
+    sizes = np.diff(split_indices, prepend=0, append=len(mol_id))
+    return split_indices, sizes
+
+
+def convert_legacy_conformations(legacy_file, conformation_file):
+    """ Convert a dataset saved in the old layout, a single float64 array of
+    [mol_id, atomic_num, x, y, z, qed, logp, sas, asphericity] rows, to the
+    per-field files read by load_split_data.
+
+    Molecule order and ids are kept, so an existing geom_permutation.npy
+    still gives the same train/val/test split.
+    """
+    all_data = np.load(legacy_file, mmap_mode='r')      # num_atoms x 9
+    mol_id = all_data[:, 0].astype(np.int32)
+    split_indices, sizes = split_and_sizes(mol_id)
+    starts = np.concatenate(([0], split_indices))[:len(sizes)]
+
+    np.save(f'{conformation_file}_mol_id.npy', mol_id)
+    for name, columns, dtype in [('atom_type', 1, np.int8),
+                                 ('coords', slice(2, 5), np.float32)]:
+        column = all_data[:, columns]
+        out = np.lib.format.open_memmap(f'{conformation_file}_{name}.npy', mode='w+',
+                                        dtype=dtype, shape=column.shape)
+        out[:] = column
+        out.flush()
+        del out
+    # The old layout repeats the properties on every atom, keep the first row
+    # of each molecule. Ids without atoms keep a row of zeros.
+    n_mol = int(mol_id[-1]) + 1 if len(mol_id) else 0
+    props = np.zeros((n_mol, all_data.shape[1] - 5), dtype=np.float32)
+    props[mol_id[starts]] = all_data[starts, 5:]
+    np.save(f'{conformation_file}_props.npy', props)
 
-    # base_path = os.path.dirname(conformation_file)
-    all_data = np.load(conformation_file)  # 2d array: num_atoms x 5
 
-    mol_id = all_data[:, 0].astype(int)
-    conformers = all_data[:, 1:]
-    # Get ids corresponding to new molecules
-    split_indices = np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1
-    data_list = np.split(conformers, split_indices)
+def load_split_data(args, conformation_file, val_proportion=0.1, test_proportion=0.1,
+                    filter_size=None):
+    """ Load the conformations written by extract_conformers and split them
+    into train/val/test lists of (atom_type, coords, props) tuples.
+
+    conformation_file is the common prefix of the per-field .npy files, e.g.
+    'geom_drugs_no_h_4_random_prop' for 'geom_drugs_no_h_4_random_prop_coords.npy'.
+    """
+    # Memory-map the files: molecules are only paged in when a sample is read.
+    mol_id_file = f'{conformation_file}_mol_id.npy'
+    mol_id = np.load(mol_id_file, mmap_mode='r')                            # num_atoms
+    atom_type = np.load(f'{conformation_file}_atom_type.npy', mmap_mode='r')  # num_atoms
+    coords = np.load(f'{conformation_file}_coords.npy', mmap_mode='r')        # num_atoms x 3
+    props = np.load(f'{conformation_file}_props.npy', mmap_mode='r')          # num_molecules x 4
+
+    # Get ids corresponding to new molecules. They only depend on the
+    # conformation file, so they are computed once and cached next to it.
+    split_file = f'{conformation_file}_split_indices.npy'
+    if (os.path.exists(split_file)
+            and os.path.getmtime(split_file) >= os.path.getmtime(mol_id_file)):
+        split_indices = np.load(split_file)
+        sizes = np.diff(split_indices, prepend=0, append=len(mol_id))
+    else:
+        split_indices, sizes = split_and_sizes(mol_id)
+        # Write to a temporary file first so concurrent runs never load a
+        # partial cache; if the directory is not writable, just don't cache.
+        tmp_file = f'{split_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.save(f, split_indices)
+            os.replace(tmp_file, split_file)
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    # Look up the properties by the id of each segment rather than by
+    # position: a conformer left without atoms (e.g. after removing
+    # hydrogens) has a props row but no atoms.
+    starts = np.concatenate(([0], split_indices))[:len(sizes)]
+    mol_props = props[mol_id[starts]]
+    data_list = list(zip(np.split(atom_type, split_indices),
+                         np.split(coords, split_indices),
+                         mol_props))
 
     # Filter based on molecule size.
     if filter_size is not None:
         # Keep only molecules <= filter_size
-        data_list = [molecule for molecule in data_list
-                     if molecule.shape[0] <= filter_size]
+        data_list = [molecule for molecule, size in zip(data_list, sizes)
+                     if size <= filter_size]
 
         assert len(data_list) > 0, 'No molecules left after filter.'
 
@@ -136,7 +264,9 @@ def load_split_data(args, conformation_file, val_proportion=0.1, test_proportion
     num_mol = len(data_list)
     val_index = int(num_mol * val_proportion)
     test_index = val_index + int(num_mol * test_proportion)
-    val_data, test_data, train_data = np.split(data_list, [val_index, test_index])
+    val_data = data_list[:val_index]
+    test_data = data_list[val_index:test_index]
+    train_data = data_list[test_index:]
     return train_data, val_data, test_data
 
 
@@ -150,11 +280,12 @@ class GeomDrugsDataset(Dataset):
         self.transform = transform
 
         # Sort the data list by size
-        lengths = [s.shape[0] for s in data_list]
+        lengths = np.array([s[0].shape[0] for s in data_list])
         argsort = np.argsort(lengths)               # Sort by decreasing size
         self.data_list = [data_list[i] for i in argsort]
         # Store indices where the size changes
-        self.split_indices = np.unique(np.sort(lengths), return_index=True)[1][1:]
+        sorted_lengths = lengths[argsort]
+        self.split_indices = np.flatnonzero(np.diff(sorted_lengths)) + 1
 
     def __len__(self):
         return len(self.data_list)
@@ -173,7 +304,8 @@ class CustomBatchSampler(BatchSampler):
     """ Creates batches where all sets have the same size. """
     def __init__(self, sampler, batch_size, drop_last, split_indices):
         super().__init__(sampler, batch_size, drop_last)
-        self.split_indices = split_indices
+        # Checked for every sample, so keep it as a set for O(1) lookups.
+        self.split_indices = frozenset(int(x) for x in split_indices)
 
     def __iter__(self):
         batch = []
@@ -198,20 +330,43 @@ class CustomBatchSampler(BatchSampler):
         return count
 
 
+# Off-diagonal masks keyed by (n_nodes, device), shared across batches.
+_DIAG_CACHE = {}
+
+
+# Per-molecule edge masks for sequential loading, keyed by number of atoms.
+_EDGE_CACHE = {}
+
+
+def _sequential_edge_mask(n):
+    edge_mask = _EDGE_CACHE.get(n)
+    if edge_mask is None:
+        edge_mask = torch.ones((n, n))
+        edge_mask[~torch.eye(n, dtype=torch.bool)] = 0
+        edge_mask = edge_mask.flatten()
+        _EDGE_CACHE[n] = edge_mask
+    return edge_mask
+
+
 def collate_fn(batch):
     batch = {prop: qm9_collate.batch_stack([mol[prop] for mol in batch])
              for prop in batch[0].keys()}
 
     atom_mask = batch['atom_mask']
 
-    # Obtain edges
+    # Obtain edges. The mask is kept as bool, consumers cast it to their dtype.
     batch_size, n_nodes = atom_mask.size()
-    edge_mask = atom_mask.unsqueeze(1) * atom_mask.unsqueeze(2)
+    am = atom_mask.bool()
+    edge_mask = am.unsqueeze(1) & am.unsqueeze(2)
 
     # mask diagonal
-    diag_mask = ~torch.eye(edge_mask.size(1), dtype=torch.bool,
-                           device=edge_mask.device).unsqueeze(0)
-    edge_mask *= diag_mask
+    key = (n_nodes, edge_mask.device)
+    diag_mask = _DIAG_CACHE.get(key)
+    if diag_mask is None:
+        diag_mask = ~torch.eye(n_nodes, dtype=torch.bool,
+                               device=edge_mask.device).unsqueeze(0)
+        _DIAG_CACHE[key] = diag_mask
+    edge_mask &= diag_mask
 
     # edge_mask = atom_mask.unsqueeze(1) * atom_mask.unsqueeze(2)
     batch['edge_mask'] = edge_mask.view(batch_size * n_nodes * n_nodes, 1)
@@ -219,6 +374,17 @@ def collate_fn(batch):
     return batch
 
 
+def collate_fn_sequential(batch):
+    """ Collate molecules that all have the same number of atoms, as produced
+    by CustomBatchSampler, so they can be stacked without padding. """
+    batch_size = len(batch)
+    n_nodes = batch[0]['positions'].size(0)
+    batch = {prop: torch.stack([mol[prop] for mol in batch])
+             for prop in batch[0].keys()}
+    batch['edge_mask'] = _sequential_edge_mask(n_nodes).repeat(batch_size, 1)
+    return batch
+
+
 class GeomDrugsDataLoader(DataLoader):
     def __init__(self, sequential, dataset, batch_size, shuffle, drop_last=False):
 
@@ -230,7 +396,8 @@ class GeomDrugsDataLoader(DataLoader):
             sampler = SequentialSampler(dataset)
             batch_sampler = CustomBatchSampler(sampler, batch_size, drop_last,
                                                dataset.split_indices)
-            super().__init__(dataset, batch_sampler=batch_sampler)
+            super().__init__(dataset, batch_sampler=batch_sampler,
+                             collate_fn=collate_fn_sequential)
 
         else:
             # Dataloader goes through data randomly and pads the molecules to
@@ -241,30 +408,33 @@ class GeomDrugsDataLoader(DataLoader):
 
 class GeomDrugsTransform(object):
     def __init__(self, dataset_info, include_charges, device, sequential):
-        self.atomic_number_list = torch.Tensor(dataset_info['atomic_nb'])[None, :]
+        self.atomic_number_list = torch.tensor(dataset_info['atomic_nb'],
+                                               dtype=torch.long).unsqueeze(0)
+        # Samples are always built on the CPU: the transform runs inside the
+        # DataLoader, whose workers cannot use CUDA, and the training loop
+        # moves each batch to `device` in one go.
         self.device = device
         self.include_charges = include_charges
         self.sequential = sequential
 
     def __call__(self, data):
-        n = data.shape[0]
+        atom_type, coords, props = data
+        n = atom_type.shape[0]
         new_data = {}
+        # The arrays may be read-only views on the memory-mapped dataset, take
+        # owned copies (converted to the final dtype in the same pass) before
+        # handing them to torch.
         #modify for context_nf = 1
-        new_data['positions'] = torch.from_numpy(data[:, 1:4])
-        atom_types = torch.from_numpy(data[:, 0].astype(int)[:, None])
-        one_hot = atom_types == self.atomic_number_list
+        new_data['positions'] = torch.from_numpy(np.array(coords, dtype=np.float32))
+        atom_types = torch.from_numpy(np.array(atom_type, dtype=np.int64))
+        one_hot = atom_types.unsqueeze(1) == self.atomic_number_list
         new_data['one_hot'] = one_hot
-        new_data['context'] = torch.from_numpy(data[:, 6:7]) / 10#remember to /10 for SAS
+        new_data['context'] = torch.full((n, 1), float(props[2]) / 10)#remember to /10 for SAS
         if self.include_charges:
-            new_data['charges'] = torch.zeros(n, 1, device=self.device)
+            new_data['charges'] = torch.zeros(n, 1)
         else:
-            new_data['charges'] = torch.zeros(0, device=self.device)
-        new_data['atom_mask'] = torch.ones(n, device=self.device)
-
-        if self.sequential:
-            edge_mask = torch.ones((n, n), device=self.device)
-            edge_mask[~torch.eye(edge_mask.shape[0], dtype=torch.bool)] = 0
-            new_data['edge_mask'] = edge_mask.flatten()
+            new_data['charges'] = torch.zeros(0)
+        new_data['atom_mask'] = torch.ones(n)
         return new_data
 
 
@@ -276,5 +446,16 @@ if __name__ == '__main__':
     parser.add_argument("--data_dir", type=str, default='/sharefs/sharefs-qb/3D_jtvae/GEOM/')
     parser.add_argument("--output_dir", type=str, default='/sharefs/sharefs-syx/qb_data/EDM')
     parser.add_argument("--data_file", type=str, default="rdkit_folder/drugs")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of processes used to read the pickle files.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random choice of conformations.")
+    parser.add_argument("--convert_legacy", type=str, default=None,
+                        help="Convert a conformation .npy in the old single-array layout "
+                             "to per-field files next to it, then exit.")
     args = parser.parse_args()
+    if args.convert_legacy is not None:
+        convert_legacy_conformations(args.convert_legacy,
+                                     os.path.splitext(args.convert_legacy)[0])
+        sys.exit(0)
     extract_conformers(args)
@@ -115,7 +115,7 @@ parser.add_argument('--sequential', action='store_true',
 parser.add_argument('--output_dir', type=str, default='/home/AI4Science/qiangb/data_from_brain++/sharefs/EDM/edm_prop/checkpoints')
 args = parser.parse_args()
 
-data_file = '/home/AI4Science/qiangb/data_from_brain++/sharefs/EDM/edm_prop/geom_drugs_no_h_4_random_prop.npy'
+data_file = '/home/AI4Science/qiangb/data_from_brain++/sharefs/EDM/edm_prop/geom_drugs_no_h_4_random_prop'
 
 
 dataset_info = geom_no_h
@@ -38,7 +38,7 @@ def retrieve_dataloaders(cfg):
     elif 'geom' in cfg.dataset:
         import build_geom_dataset
         from configs.datasets_config import get_dataset_info
-        data_file = '/sharefs/sharefs-syx/qb_data/EDM/geom_drugs_no_h_4_random_prop.npy'
+        data_file = '/sharefs/sharefs-syx/qb_data/EDM/geom_drugs_no_h_4_random_prop'
         dataset_info = get_dataset_info(cfg.dataset, cfg.remove_h)
 
         # Retrieve QM9 dataloaders